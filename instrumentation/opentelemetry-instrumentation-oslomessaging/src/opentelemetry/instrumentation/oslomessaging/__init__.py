@@ -34,19 +34,150 @@ The instrumentation works by wrapping the core RPC client and server methods
 of oslo.messaging to automatically create and propagate trace spans.
 """
 
-import functools
+import copy
+import importlib
+import operator
 import typing
+from os import environ
 from typing import Any, Callable
 
-from opentelemetry import trace
+from opentelemetry import context, trace
 from opentelemetry.instrumentation.instrumentor import BaseInstrumentor
-from opentelemetry.instrumentation.utils import unwrap
-from opentelemetry.propagate import inject, extract
+from opentelemetry.instrumentation.oslomessaging.environment_variables import (
+    OTEL_OSLO_RECORD_EXCEPTIONS,
+)
+from opentelemetry.instrumentation.oslomessaging.package import _instruments
+from opentelemetry.instrumentation.oslomessaging.version import __version__
+from opentelemetry.propagate import extract, inject
 from opentelemetry.trace import SpanKind
 
-from opentelemetry.instrumentation.oslomessaging.version import __version__
+_RPC_CALL_METHODS = ("cast", "call", "call_async")
+_RPC_SYSTEM = "oslo_messaging"
+_SERVER_SPAN_PREFIX = "oslo_messaging.rpc.server."
+_RECORD_EXCEPTIONS = environ.get(OTEL_OSLO_RECORD_EXCEPTIONS, "0") == "1"
+_ERROR_STATUS = trace.Status(trace.StatusCode.ERROR)
+
+# Incoming message contexts have a stable type for a given deployment, so the
+# function turning them into a dict is resolved once per type
+_CTXT_EXTRACTORS: typing.Dict[type, Callable[[Any], typing.Optional[dict]]] = {}
+
+
+def _unwrap(obj: Any, attr: str) -> None:
+    """
+    Restore a method wrapped by this instrumentation.
+
+    ``opentelemetry.instrumentation.utils.unwrap`` only handles wrapt proxies,
+    while the wrappers here are plain functions exposing ``__wrapped__``.
+    """
+    func = getattr(obj, attr, None)
+    if func is not None and hasattr(func, "__wrapped__"):
+        setattr(obj, attr, func.__wrapped__)
+
+
+def _is_noop_tracer(tracer: trace.Tracer) -> bool:
+    """
+    Return whether spans created by ``tracer`` can never be recorded.
+
+    A ``ProxyTracer`` keeps delegating to a no-op tracer until an SDK
+    ``TracerProvider`` is configured, so it is resolved on every check.
+    """
+    if isinstance(tracer, trace.ProxyTracer):
+        tracer = tracer._tracer  # pylint: disable=protected-access
+    return isinstance(tracer, trace.NoOpTracer)
+
+
+def _rpc_attributes(method: str, target: Any) -> typing.Dict[str, str]:
+    """
+    Build the attributes of an RPC span, set on it in a single call.
+    """
+    attributes = {"rpc.method": method, "rpc.system": _RPC_SYSTEM}
+    # The topic names the service, the rest of the target (server, version)
+    # varies between hosts and releases
+    topic = getattr(target, "topic", None)
+    if topic is not None:
+        attributes["rpc.service"] = topic
+    return attributes
+
+
+def _no_ctxt(ctxt: Any) -> None:
+    return None
+
+
+def _no_copy(ctxt: dict) -> dict:
+    return ctxt
+
 
-_RPC_CALL_METHODS = ["cast", "call"]
+def _ctxt_as_dict(ctxt: Any) -> typing.Optional[dict]:
+    try:
+        return dict(ctxt)
+    except (TypeError, ValueError):
+        return None
+
+
+def _resolve_ctxt_extractor(
+    ctxt_type: type,
+) -> Callable[[Any], typing.Optional[dict]]:
+    """
+    Pick and memoize the function extracting a dict from an incoming context.
+
+    Handles different context types, including
+    oslo_context.context.RequestContext.
+    """
+    if hasattr(ctxt_type, "to_dict"):
+        extractor = operator.methodcaller("to_dict")
+    elif issubclass(ctxt_type, dict):
+        # Only read from, no need to copy it
+        extractor = _no_copy
+    elif hasattr(ctxt_type, "get"):
+        extractor = dict
+    elif issubclass(ctxt_type, type(None)):
+        extractor = _no_ctxt
+    else:
+        extractor = _ctxt_as_dict
+    _CTXT_EXTRACTORS[ctxt_type] = extractor
+    return extractor
+
+
+class _TracingSerializer:
+    """
+    A client serializer adding the trace context to the serialized context.
+
+    Serializers such as nova's ``RequestContextSerializer`` expect the
+    caller's request context, so the carrier is only added to the context
+    they produce. Entities are serialized by the wrapped serializer as is.
+    """
+
+    __slots__ = ("_serializer", "_carrier")
+
+    def __init__(
+        self, serializer: Any, carrier: typing.Dict[str, str]
+    ) -> None:
+        self._serializer = serializer
+        self._carrier = carrier
+
+    def serialize_entity(self, ctxt: Any, entity: Any) -> Any:
+        return self._serializer.serialize_entity(ctxt, entity)
+
+    def deserialize_entity(self, ctxt: Any, entity: Any) -> Any:
+        return self._serializer.deserialize_entity(ctxt, entity)
+
+    def serialize_context(self, ctxt: Any) -> dict:
+        msg_ctxt = self._serializer.serialize_context(ctxt)
+        if hasattr(msg_ctxt, "to_dict"):
+            # NoOpSerializer passes the context through, drivers would call
+            # to_dict() on it anyway
+            msg_ctxt = msg_ctxt.to_dict()
+        elif not msg_ctxt:
+            return {"_trace_context": self._carrier}
+        elif msg_ctxt is ctxt or not isinstance(msg_ctxt, dict):
+            # The caller's context must not be modified
+            return dict(msg_ctxt, _trace_context=self._carrier)
+        # to_dict() and serializers return a fresh dict which can be updated
+        msg_ctxt["_trace_context"] = self._carrier
+        return msg_ctxt
+
+    def deserialize_context(self, ctxt: Any) -> Any:
+        return self._serializer.deserialize_context(ctxt)
 
 
 class OsloMessagingInstrumentor(BaseInstrumentor):
@@ -56,11 +187,16 @@ class OsloMessagingInstrumentor(BaseInstrumentor):
     See `BaseInstrumentor`
     """
 
+    # Set by _instrument. Not initialised in __init__, which runs again on
+    # every OsloMessagingInstrumentor() call of the singleton
+    _client_cls = None
+    _server_cls = None
+    _wrapped_client_methods = ()
+
     def instrumentation_dependencies(self) -> typing.Collection[str]:
         """
         Return a list of python packages that this instrumentation depends on.
         """
-        from opentelemetry.instrumentation.oslomessaging.package import _instruments
         return _instruments
 
     def _instrument(self, **kwargs: Any) -> None:
@@ -73,7 +209,10 @@ class OsloMessagingInstrumentor(BaseInstrumentor):
             __version__,
             tracer_provider,
         )
-        
+
+        if not self._resolve_targets():
+            return
+
         # Instrument RPC client methods
         self._instrument_client(tracer)
         # Instrument RPC server methods
@@ -83,94 +222,89 @@ class OsloMessagingInstrumentor(BaseInstrumentor):
         """
         Uninstrument the oslo.messaging RPC module.
         """
+        if self._client_cls is None or self._server_cls is None:
+            return
+
         # Uninstrument RPC client methods
         self._uninstrument_client()
         # Uninstrument RPC server methods
         self._uninstrument_server()
+        self._client_cls = None
+        self._server_cls = None
+
+    def _resolve_targets(self) -> bool:
+        """
+        Resolve the oslo.messaging classes to (un)instrument.
+
+        They are stored on the instrumentor so that uninstrumenting restores
+        the very classes that were patched, without importing anything.
+        """
+        try:
+            client_mod = importlib.import_module("oslo_messaging.rpc.client")
+            server_mod = importlib.import_module("oslo_messaging.rpc.server")
+            self._client_cls = client_mod._BaseCallContext
+            self._server_cls = server_mod.RPCServer
+        except (ImportError, AttributeError):
+            # oslo.messaging is not installed or has an unexpected layout
+            self._client_cls = None
+            self._server_cls = None
+            return False
+        return True
 
     def _instrument_client(self, tracer: trace.Tracer) -> None:
         """
         Instrument RPC client methods to create spans and inject trace context.
         """
-        try:
-            import oslo_messaging.rpc.client
-            
-            # Get the original methods
-            original_base_call_context = oslo_messaging.rpc.client._BaseCallContext
-            
-            # Create wrapper methods
-            for method_name in _RPC_CALL_METHODS:
-                if hasattr(original_base_call_context, method_name):
-                    original_method = getattr(original_base_call_context, method_name)
-                    wrapped_method = self._wrap_client_method(
-                        original_method, tracer, method_name
-                    )
-                    setattr(original_base_call_context, method_name, wrapped_method)
-            
-            # Add trace context injection method
-            if not hasattr(original_base_call_context, "_inject_trace_context"):
-                setattr(
-                    original_base_call_context,
-                    "_inject_trace_context",
-                    self._inject_trace_context
-                )
-                
-        except ImportError:
-            # oslo.messaging is not installed
-            pass
+        # Get the original methods, kept to restore them on uninstrument
+        original_base_call_context = self._client_cls
+        self._wrapped_client_methods = [
+            (method_name, getattr(original_base_call_context, method_name))
+            for method_name in _RPC_CALL_METHODS
+            if hasattr(original_base_call_context, method_name)
+        ]
+
+        # Create wrapper methods
+        patched = {
+            method_name: self._wrap_client_method(
+                original_method, tracer, method_name
+            )
+            for method_name, original_method in self._wrapped_client_methods
+        }
+
+        # Assign everything back to back: CPython invalidates the method cache
+        # of the class on the first assignment, later ones are free as long as
+        # no attribute is looked up on the class in between
+        for name, value in patched.items():
+            setattr(original_base_call_context, name, value)
 
     def _uninstrument_client(self) -> None:
         """
         Uninstrument RPC client methods.
         """
-        try:
-            import oslo_messaging.rpc.client
-            
-            for method_name in _RPC_CALL_METHODS:
-                if hasattr(oslo_messaging.rpc.client._BaseCallContext, method_name):
-                    unwrap(oslo_messaging.rpc.client._BaseCallContext, method_name)
-            
-            # Remove the trace context injection method if it exists
-            if hasattr(oslo_messaging.rpc.client._BaseCallContext, "_inject_trace_context"):
-                delattr(oslo_messaging.rpc.client._BaseCallContext, "_inject_trace_context")
-                
-        except ImportError:
-            pass
+        base_call_context = self._client_cls
+
+        for method_name, original_method in self._wrapped_client_methods:
+            setattr(base_call_context, method_name, original_method)
+        self._wrapped_client_methods = []
 
     def _instrument_server(self, tracer: trace.Tracer) -> None:
         """
         Instrument RPC server methods to extract trace context and create spans.
         """
-        try:
-            import oslo_messaging.rpc.server
-            
-            # Wrap the process_incoming method
-            original_process_incoming = oslo_messaging.rpc.server.RPCServer._process_incoming
-            wrapped_process_incoming = self._wrap_server_process_incoming(
-                original_process_incoming, tracer
-            )
-            setattr(
-                oslo_messaging.rpc.server.RPCServer, 
-                "_process_incoming", 
-                wrapped_process_incoming
-            )
-            
-        except ImportError:
-            pass
+        # Wrap the process_incoming method
+        rpc_server = self._server_cls
+        wrapped_process_incoming = self._wrap_server_process_incoming(
+            rpc_server._process_incoming, tracer
+        )
+        setattr(rpc_server, "_process_incoming", wrapped_process_incoming)
 
     def _uninstrument_server(self) -> None:
         """
         Uninstrument RPC server methods.
         """
-        try:
-            import oslo_messaging.rpc.server
-            
-            # Unwrap the process_incoming method
-            if hasattr(oslo_messaging.rpc.server.RPCServer, "_process_incoming"):
-                unwrap(oslo_messaging.rpc.server.RPCServer, "_process_incoming")
-                
-        except ImportError:
-            pass
+        # Unwrap the process_incoming method
+        if hasattr(self._server_cls, "_process_incoming"):
+            _unwrap(self._server_cls, "_process_incoming")
 
     def _wrap_client_method(
         self, original_method: Callable[..., Any], tracer: trace.Tracer, method_name: str
@@ -178,38 +312,57 @@ class OsloMessagingInstrumentor(BaseInstrumentor):
         """
         Wrap an RPC client method to create a span and inject trace context.
         """
-        @functools.wraps(original_method)
-        def wrapper(self, ctxt, method, **kwargs):
-            # Create a span for the RPC call
-            with tracer.start_as_current_span(
-                f"oslo_messaging.rpc.{method_name}",
-                kind=SpanKind.CLIENT,
-            ) as span:
-                # Add span attributes
-                span.set_attribute("rpc.method", method)
-                span.set_attribute("rpc.system", "oslo_messaging")
-                span.set_attribute("rpc.service", getattr(self, "target", None))
-                
+        span_name = f"oslo_messaging.rpc.{method_name}"
+        # The wrapper's self is the call context
+        inject_trace_context = self._inject_trace_context
+
+        def wrapper(self, ctxt, method, *args, **kwargs):
+            # Nothing will be recorded, skip the span but still propagate the
+            # current context, e.g. an upstream trace and baggage
+            if _is_noop_tracer(tracer):
+                call_context, ctxt = inject_trace_context(self, ctxt)
+                return original_method(
+                    call_context, ctxt, method, *args, **kwargs
+                )
+
+            # Create a span for the RPC call and make it current
+            span = tracer.start_span(span_name, kind=SpanKind.CLIENT)
+            token = context.attach(trace.set_span_in_context(span))
+            try:
+                # Add span attributes, unless the span was sampled out
+                if span.is_recording():
+                    span.set_attributes(
+                        _rpc_attributes(method, getattr(self, "target", None))
+                    )
+
                 # Inject trace context into the message
-                if not ctxt:
-                    ctxt = {}
-                # Use the updated context returned by _inject_trace_context
-                ctxt = self._inject_trace_context(ctxt)
-                
+                call_context, ctxt = inject_trace_context(self, ctxt)
+
                 # Call the original method
-                try:
-                    result = original_method(self, ctxt, method, **kwargs)
-                    return result
-                except Exception as e:
-                    # Record the exception
+                result = original_method(
+                    call_context, ctxt, method, *args, **kwargs
+                )
+                return result
+            except Exception as e:
+                # Formatting the traceback is costly, only record it on demand
+                if _RECORD_EXCEPTIONS:
                     span.record_exception(e)
-                    span.set_status(trace.Status(trace.StatusCode.ERROR))
-                    raise
+                span.set_status(_ERROR_STATUS)
+                span.set_attribute("error.type", type(e).__qualname__)
+                raise
+            finally:
+                context.detach(token)
+                span.end()
+
+        # No functools.wraps, only __wrapped__ is used to unwrap
+        wrapper.__wrapped__ = original_method
         return wrapper
 
-    def _inject_trace_context(self, ctxt):
+    def _inject_trace_context(self, call_context, ctxt):
         """
         Inject trace context into the message context.
+
+        Return the call context and the message context to send with.
         """
         # Use a carrier dictionary to hold the propagated context
         carrier = {}
@@ -217,11 +370,18 @@ class OsloMessagingInstrumentor(BaseInstrumentor):
         
         # Handle different context types, including oslo_context.context.RequestContext
         if hasattr(ctxt, "to_dict"):
-            ctxt_dict = ctxt.to_dict()
-        else:
-            ctxt_dict = dict(ctxt or {})
-        ctxt_dict["_trace_context"] = carrier
-        return ctxt_dict
+            # Keep the caller's context for the client serializer, the carrier
+            # is added once it is serialized. The call context is copied as
+            # callers may share a prepared one between threads
+            call_context = copy.copy(call_context)
+            call_context.serializer = _TracingSerializer(
+                call_context.serializer, carrier
+            )
+            return call_context, ctxt
+        if not ctxt:
+            return call_context, {"_trace_context": carrier}
+        # Copy in a single pass, the caller's context must not be modified
+        return call_context, dict(ctxt, _trace_context=carrier)
 
     def _wrap_server_process_incoming(
         self, original_method: Callable[..., Any], tracer: trace.Tracer
@@ -229,54 +389,73 @@ class OsloMessagingInstrumentor(BaseInstrumentor):
         """
         Wrap the RPC server process_incoming method to extract trace context and create spans.
         """
-        @functools.wraps(original_method)
         def wrapper(self, incoming):
-            # Extract trace context from the message if available
-            ctx = None
-            if hasattr(incoming, "ctxt") and hasattr(incoming, "message"):
-                # Try to extract from message context
-                # Handle different context types, including oslo_context.context.RequestContext
-                ctxt_dict = None
-                if hasattr(incoming.ctxt, "to_dict"):
-                    ctxt_dict = incoming.ctxt.to_dict()
-                elif hasattr(incoming.ctxt, "get"):
-                    ctxt_dict = dict(incoming.ctxt)
-                elif incoming.ctxt is not None:
-                    try:
-                        ctxt_dict = dict(incoming.ctxt)
-                    except (TypeError, ValueError):
-                        ctxt_dict = None
-                
-                if ctxt_dict and "_trace_context" in ctxt_dict:
-                    carrier = ctxt_dict["_trace_context"]
-                    ctx = extract(carrier)
-                
-                # Get method information for span name
-                method = incoming.message.get("method", "unknown")
-                
-                # Create a server span with the extracted context
-                with tracer.start_as_current_span(
-                    f"oslo_messaging.rpc.server.{method}",
-                    context=ctx,
-                    kind=SpanKind.SERVER,
-                ) as span:
-                    # Add span attributes
-                    span.set_attribute("rpc.method", method)
-                    span.set_attribute("rpc.system", "oslo_messaging")
-                    span.set_attribute("rpc.service", getattr(self, "target", None))
-                    
-                    # Call the original method
-                    try:
-                        result = original_method(self, incoming)
-                        return result
-                    except Exception as e:
-                        # Record the exception
-                        span.record_exception(e)
-                        span.set_status(trace.Status(trace.StatusCode.ERROR))
-                        raise
-            else:
-                # If the message structure is not as expected, call the original method
+            # RPCServer._process_incoming receives a batch of one message
+            message = incoming
+            if isinstance(incoming, list):
+                if not incoming:
+                    return original_method(self, incoming)
+                message = incoming[0]
+
+            # If the message structure is not as expected, call the original method
+            if not (hasattr(message, "ctxt") and hasattr(message, "message")):
+                return original_method(self, incoming)
+
+            # Extract trace context from the message context
+            ctxt = message.ctxt
+            extractor = _CTXT_EXTRACTORS.get(type(ctxt))
+            if extractor is None:
+                extractor = _resolve_ctxt_extractor(type(ctxt))
+            ctxt_dict = extractor(ctxt)
+
+            # Only trace messages sent by an instrumented client
+            if not ctxt_dict or "_trace_context" not in ctxt_dict:
                 return original_method(self, incoming)
+            ctx = extract(ctxt_dict["_trace_context"])
+
+            # Nothing will be recorded, skip the span but still make the
+            # propagated context current
+            if _is_noop_tracer(tracer):
+                token = context.attach(ctx)
+                try:
+                    return original_method(self, incoming)
+                finally:
+                    context.detach(token)
+
+            # Get method information for span name
+            method = message.message.get("method", "unknown")
+
+            # Create a server span with the extracted context
+            span = tracer.start_span(
+                f"{_SERVER_SPAN_PREFIX}{method}",
+                context=ctx,
+                kind=SpanKind.SERVER,
+            )
+            token = context.attach(trace.set_span_in_context(span, ctx))
+            try:
+                # Add span attributes, unless the span was sampled out
+                if span.is_recording():
+                    # RPCServer keeps its target private
+                    span.set_attributes(
+                        _rpc_attributes(method, getattr(self, "_target", None))
+                    )
+
+                # Call the original method
+                result = original_method(self, incoming)
+                return result
+            except Exception as e:
+                # Formatting the traceback is costly, only record it on demand
+                if _RECORD_EXCEPTIONS:
+                    span.record_exception(e)
+                span.set_status(_ERROR_STATUS)
+                span.set_attribute("error.type", type(e).__qualname__)
+                raise
+            finally:
+                context.detach(token)
+                span.end()
+
+        # No functools.wraps, only __wrapped__ is used to unwrap
+        wrapper.__wrapped__ = original_method
         return wrapper
 
 __all__ = ["OsloMessagingInstrumentor"]
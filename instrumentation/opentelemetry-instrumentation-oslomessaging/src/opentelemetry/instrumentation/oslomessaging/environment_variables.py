@@ -0,0 +1,21 @@
+# Copyright The OpenTelemetry Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+OTEL_OSLO_RECORD_EXCEPTIONS = "OTEL_OSLO_RECORD_EXCEPTIONS"
+"""
+.. envvar:: OTEL_OSLO_RECORD_EXCEPTIONS
+
+Set to ``1`` to add an exception event, including the formatted traceback,
+to RPC spans that fail. By default failed spans only get an error status.
+"""
@@ -17,6 +17,14 @@ from unittest import mock
 
 from opentelemetry.instrumentation.oslomessaging import OsloMessagingInstrumentor
 
+# A ``None`` entry in sys.modules makes the import raise ImportError
+_UNAVAILABLE_MODULES = {
+    "oslo_messaging": None,
+    "oslo_messaging.rpc": None,
+    "oslo_messaging.rpc.client": None,
+    "oslo_messaging.rpc.server": None,
+}
+
 
 class TestOsloMessagingIntegration(unittest.TestCase):
     """Test integration with oslo.messaging"""
@@ -44,13 +52,14 @@ class TestOsloMessagingIntegration(unittest.TestCase):
         self.patcher = mock.patch.dict(
             "sys.modules",
             {
-                "oslo.messaging.rpc.client": self.mock_rpc_client,
-                "oslo.messaging.rpc.server": self.mock_rpc_server,
+                "oslo_messaging.rpc.client": self.mock_rpc_client,
+                "oslo_messaging.rpc.server": self.mock_rpc_server,
             },
         )
         self.patcher.start()
 
     def tearDown(self):
+        OsloMessagingInstrumentor().uninstrument()
         self.patcher.stop()
 
     def test_instrument(self):
@@ -72,9 +81,6 @@ class TestOsloMessagingIntegration(unittest.TestCase):
             self.mock_base_call_context.call_async
         )
         
-        # Check that _inject_trace_context method is added
-        self.assertTrue(hasattr(self.mock_base_call_context, "_inject_trace_context"))
-        
         # Check that server method is wrapped
         self.assertNotEqual(
             self.mock_rpc_server_class._process_incoming.__wrapped__,
@@ -95,25 +101,34 @@ class TestOsloMessagingIntegration(unittest.TestCase):
         with self.assertRaises(AttributeError):
             getattr(self.mock_base_call_context.call_async, "__wrapped__")
         
-        # Check that _inject_trace_context method is removed
-        self.assertFalse(hasattr(self.mock_base_call_context, "_inject_trace_context"))
-        
         # Check that server method is unwrapped
         with self.assertRaises(AttributeError):
             getattr(self.mock_rpc_server_class._process_incoming, "__wrapped__")
 
+    def test_uninstrument_without_import(self):
+        """Test that uninstrument restores the instrumented classes without importing them"""
+        instrumentor = OsloMessagingInstrumentor()
+        instrumentor.instrument()
+        with mock.patch.dict("sys.modules", _UNAVAILABLE_MODULES):
+            instrumentor.uninstrument()
+
+        with self.assertRaises(AttributeError):
+            getattr(self.mock_base_call_context.call, "__wrapped__")
+        with self.assertRaises(AttributeError):
+            getattr(self.mock_rpc_server_class._process_incoming, "__wrapped__")
+
     def test_instrument_unavailable(self):
         """Test that instrument works even if oslo.messaging is not available"""
-        # Remove oslo.messaging from sys.modules
-        with mock.patch.dict("sys.modules", clear=True):
+        # Make oslo.messaging unimportable
+        with mock.patch.dict("sys.modules", _UNAVAILABLE_MODULES):
             instrumentor = OsloMessagingInstrumentor()
             # This should not raise an exception
             instrumentor.instrument()
 
     def test_uninstrument_unavailable(self):
         """Test that uninstrument works even if oslo.messaging is not available"""
-        # Remove oslo.messaging from sys.modules
-        with mock.patch.dict("sys.modules", clear=True):
+        # Make oslo.messaging unimportable
+        with mock.patch.dict("sys.modules", _UNAVAILABLE_MODULES):
             instrumentor = OsloMessagingInstrumentor()
             # This should not raise an exception
             instrumentor.uninstrument()
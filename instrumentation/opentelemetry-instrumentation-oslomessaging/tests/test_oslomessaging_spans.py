@@ -0,0 +1,431 @@
+# Copyright The OpenTelemetry Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import types
+from unittest import mock
+
+import oslo_messaging
+from oslo_config import cfg
+
+from opentelemetry import baggage, context, propagate, trace
+from opentelemetry.instrumentation.oslomessaging import (
+    OsloMessagingInstrumentor,
+)
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF
+from opentelemetry.test.test_base import TestBase
+from opentelemetry.trace import SpanKind
+
+_TRACE_ID = 0x4BF92F3577B34DA6A3CE929D0E0E4736
+_CARRIER = {
+    "traceparent": "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-00"
+}
+
+
+class FakeCallContext:
+    """Stand-in for oslo_messaging.rpc.client._BaseCallContext"""
+
+    def __init__(self, error=None):
+        self.target = oslo_messaging.Target(
+            topic="test_topic", version="5.0", server="host-1"
+        )
+        self.serializer = oslo_messaging.NoOpSerializer()
+        self.error = error
+        self.sent = []
+
+    def cast(self, ctxt, method, **kwargs):
+        msg_ctxt = self.serializer.serialize_context(ctxt)
+        self.sent.append((msg_ctxt, method, kwargs))
+
+    def call(self, ctxt, method, **kwargs):
+        msg_ctxt = self.serializer.serialize_context(ctxt)
+        self.sent.append((msg_ctxt, method, kwargs))
+        if self.error is not None:
+            raise self.error
+        return "result"
+
+
+class FakeRPCServer:
+    """Stand-in for oslo_messaging.rpc.server.RPCServer"""
+
+    def __init__(self):
+        self._target = oslo_messaging.Target(
+            topic="test_topic", server="host-1"
+        )
+        self.processed = []
+        self.baggage = []
+
+    def _process_incoming(self, incoming):
+        self.processed.append((incoming, trace.get_current_span()))
+        self.baggage.append(baggage.get_all())
+
+
+class FakeRequestContext:
+    """Stand-in for oslo_context.context.RequestContext"""
+
+    def __init__(self, values=None):
+        self.values = values or {"user": "admin"}
+
+    def to_dict(self):
+        return dict(self.values)
+
+
+class RequestContextSerializer(oslo_messaging.NoOpSerializer):
+    """Serializes request contexts with to_dict(), as nova's does"""
+
+    def serialize_context(self, ctxt):
+        return ctxt.to_dict()
+
+
+def _incoming(ctxt, method="hello"):
+    # RPCServer._process_incoming receives a batch of one message
+    return [types.SimpleNamespace(ctxt=ctxt, message={"method": method})]
+
+
+class TestOsloMessagingSpans(TestBase):
+    """Test the spans produced by the client and server wrappers"""
+
+    def setUp(self):
+        super().setUp()
+        self.patcher = mock.patch.dict(
+            "sys.modules",
+            {
+                "oslo_messaging.rpc.client": types.SimpleNamespace(
+                    _BaseCallContext=FakeCallContext
+                ),
+                "oslo_messaging.rpc.server": types.SimpleNamespace(
+                    RPCServer=FakeRPCServer
+                ),
+            },
+        )
+        self.patcher.start()
+
+    def tearDown(self):
+        OsloMessagingInstrumentor().uninstrument()
+        self.patcher.stop()
+        super().tearDown()
+
+    def test_client_span(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        client = FakeCallContext()
+        request_ctxt = {"user": "admin"}
+        self.assertEqual(
+            client.call(request_ctxt, "hello", name="world"), "result"
+        )
+        self.assertEqual(request_ctxt, {"user": "admin"})
+
+        span = self.memory_exporter.get_finished_spans()[0]
+        self.assertEqual(span.name, "oslo_messaging.rpc.call")
+        self.assertEqual(span.kind, SpanKind.CLIENT)
+        self.assertSpanHasAttributes(
+            span,
+            {
+                "rpc.method": "hello",
+                "rpc.system": "oslo_messaging",
+                "rpc.service": "test_topic",
+            },
+        )
+
+        self.assertFalse(hasattr(FakeCallContext, "_inject_trace_context"))
+        ctxt, method, kwargs = client.sent[0]
+        self.assertEqual(method, "hello")
+        self.assertEqual(kwargs, {"name": "world"})
+        self.assertEqual(ctxt["user"], "admin")
+        self.assertIn("traceparent", ctxt["_trace_context"])
+
+    def test_client_error(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        client = FakeCallContext(error=ValueError("boom"))
+        with self.assertRaises(ValueError):
+            client.call({}, "hello")
+
+        span = self.memory_exporter.get_finished_spans()[0]
+        self.assertEqual(span.status.status_code, trace.StatusCode.ERROR)
+        self.assertIsNone(span.status.description)
+        self.assertEqual(span.attributes["error.type"], "ValueError")
+        self.assertEqual(len(span.events), 0)
+        self.assertFalse(trace.get_current_span().get_span_context().is_valid)
+
+    @mock.patch(
+        "opentelemetry.instrumentation.oslomessaging._RECORD_EXCEPTIONS", True
+    )
+    def test_client_error_record_exceptions(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        client = FakeCallContext(error=ValueError("boom"))
+        with self.assertRaises(ValueError):
+            client.call({}, "hello")
+
+        span = self.memory_exporter.get_finished_spans()[0]
+        self.assertEqual(span.status.status_code, trace.StatusCode.ERROR)
+        self.assertEqual(len(span.events), 1)
+        self.assertEqual(span.events[0].name, "exception")
+
+    def test_inject_baggage_without_active_span(self):
+        token = context.attach(baggage.set_baggage("tenant", "demo"))
+        try:
+            _, ctxt = OsloMessagingInstrumentor()._inject_trace_context(
+                FakeCallContext(), {}
+            )
+        finally:
+            context.detach(token)
+        self.assertEqual(ctxt["_trace_context"], {"baggage": "tenant=demo"})
+
+    def test_server_span_continues_client_trace(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        client = FakeCallContext()
+        client.cast({}, "hello")
+        ctxt, _, _ = client.sent[0]
+
+        server = FakeRPCServer()
+        server._process_incoming(_incoming(ctxt))
+
+        client_span, server_span = self.memory_exporter.get_finished_spans()
+        self.assertEqual(server_span.name, "oslo_messaging.rpc.server.hello")
+        self.assertEqual(server_span.kind, SpanKind.SERVER)
+        self.assertEqual(
+            server_span.context.trace_id, client_span.context.trace_id
+        )
+        self.assertEqual(
+            server_span.parent.span_id, client_span.context.span_id
+        )
+        self.assertSpanHasAttributes(
+            server_span,
+            {
+                "rpc.method": "hello",
+                "rpc.system": "oslo_messaging",
+                "rpc.service": "test_topic",
+            },
+        )
+        _, current_span = server.processed[0]
+        self.assertEqual(
+            current_span.get_span_context().span_id,
+            server_span.context.span_id,
+        )
+
+    def test_server_non_str_method(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        client = FakeCallContext()
+        client.cast({}, "hello")
+        ctxt, _, _ = client.sent[0]
+
+        server = FakeRPCServer()
+        server._process_incoming(_incoming(ctxt, method=None))
+
+        self.assertEqual(len(server.processed), 1)
+        _, server_span = self.memory_exporter.get_finished_spans()
+        self.assertEqual(server_span.name, "oslo_messaging.rpc.server.None")
+
+    def test_server_attributes_error(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        client = FakeCallContext()
+        client.cast({}, "hello")
+        ctxt, _, _ = client.sent[0]
+
+        server = FakeRPCServer()
+        with mock.patch(
+            "opentelemetry.instrumentation.oslomessaging._rpc_attributes",
+            side_effect=ValueError("boom"),
+        ):
+            with self.assertRaises(ValueError):
+                server._process_incoming(_incoming(ctxt))
+
+        self.assertEqual(len(self.memory_exporter.get_finished_spans()), 2)
+        self.assertFalse(trace.get_current_span().get_span_context().is_valid)
+
+    def test_server_request_context(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        client = FakeCallContext()
+        request_ctxt = FakeRequestContext()
+        client.cast(request_ctxt, "hello")
+        self.assertEqual(request_ctxt.values, {"user": "admin"})
+        self.assertIsInstance(client.serializer, oslo_messaging.NoOpSerializer)
+        ctxt_dict, _, _ = client.sent[0]
+        self.assertEqual(ctxt_dict["user"], "admin")
+        self.assertIn("_trace_context", ctxt_dict)
+
+        server = FakeRPCServer()
+        server._process_incoming(_incoming(FakeRequestContext(ctxt_dict)))
+
+        client_span, server_span = self.memory_exporter.get_finished_spans()
+        self.assertEqual(
+            server_span.parent.span_id, client_span.context.span_id
+        )
+
+    def test_server_without_trace_context(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+
+        server = FakeRPCServer()
+        server._process_incoming(_incoming({"user": "admin"}))
+        server._process_incoming(_incoming(None))
+
+        self.assertEqual(len(server.processed), 2)
+        self.assertEqual(len(self.memory_exporter.get_finished_spans()), 0)
+
+    def test_server_span_sampled_out(self):
+        tracer_provider, memory_exporter = self.create_tracer_provider(
+            sampler=ALWAYS_OFF
+        )
+        OsloMessagingInstrumentor().instrument(tracer_provider=tracer_provider)
+
+        server = FakeRPCServer()
+        server._process_incoming(_incoming({"_trace_context": _CARRIER}))
+
+        self.assertEqual(len(memory_exporter.get_finished_spans()), 0)
+        _, current_span = server.processed[0]
+        self.assertFalse(current_span.is_recording())
+        self.assertEqual(current_span.get_span_context().trace_id, _TRACE_ID)
+
+    def test_noop_tracer_provider(self):
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=trace.NoOpTracerProvider()
+        )
+
+        # A remote parent and baggage received from upstream
+        upstream = dict(_CARRIER, baggage="tenant=demo")
+        token = context.attach(propagate.extract(upstream))
+        try:
+            client = FakeCallContext()
+            ctxt = {"user": "admin"}
+            client.cast(ctxt, "hello")
+        finally:
+            context.detach(token)
+        self.assertNotIn("_trace_context", ctxt)
+        sent_ctxt, _, _ = client.sent[0]
+        self.assertEqual(sent_ctxt["_trace_context"], upstream)
+
+        server = FakeRPCServer()
+        server._process_incoming(_incoming(sent_ctxt))
+
+        self.assertEqual(len(self.memory_exporter.get_finished_spans()), 0)
+        _, current_span = server.processed[0]
+        self.assertEqual(current_span.get_span_context().trace_id, _TRACE_ID)
+        self.assertEqual(server.baggage[0], {"tenant": "demo"})
+        self.assertFalse(trace.get_current_span().get_span_context().is_valid)
+
+
+class HelloEndpoint:
+    def __init__(self):
+        self.received = []
+
+    def hello(self, ctxt, name):
+        self.received.append((ctxt, trace.get_current_span()))
+        return f"Hello, {name}!"
+
+
+class TestOsloMessagingFakeDriver(TestBase):
+    """Test a round trip through the oslo.messaging in-process driver"""
+
+    def setUp(self):
+        super().setUp()
+        OsloMessagingInstrumentor().instrument(
+            tracer_provider=self.tracer_provider
+        )
+        self.transport = oslo_messaging.get_rpc_transport(
+            cfg.CONF, url="fake:"
+        )
+        self.endpoint = HelloEndpoint()
+        self.server = oslo_messaging.get_rpc_server(
+            self.transport,
+            oslo_messaging.Target(topic="test_topic", server="host-1"),
+            [self.endpoint],
+            executor="threading",
+        )
+        self.server.start()
+        self.client = oslo_messaging.get_rpc_client(
+            self.transport, oslo_messaging.Target(topic="test_topic")
+        )
+
+    def tearDown(self):
+        self.server.stop()
+        self.server.wait()
+        OsloMessagingInstrumentor().uninstrument()
+        super().tearDown()
+
+    def test_call(self):
+        self.assertEqual(
+            self.client.call({}, "hello", name="world"), "Hello, world!"
+        )
+
+        spans = self.memory_exporter.get_finished_spans()
+        server_span = next(s for s in spans if s.kind == SpanKind.SERVER)
+        client_span = next(s for s in spans if s.kind == SpanKind.CLIENT)
+        self.assertEqual(server_span.name, "oslo_messaging.rpc.server.hello")
+        self.assertEqual(
+            server_span.parent.span_id, client_span.context.span_id
+        )
+        self.assertEqual(client_span.attributes["rpc.service"], "test_topic")
+        self.assertEqual(server_span.attributes["rpc.service"], "test_topic")
+        _, current_span = self.endpoint.received[0]
+        self.assertEqual(
+            current_span.get_span_context().span_id,
+            server_span.context.span_id,
+        )
+
+    def test_call_request_context(self):
+        self.assertEqual(
+            self.client.call(FakeRequestContext(), "hello", name="world"),
+            "Hello, world!",
+        )
+
+        spans = self.memory_exporter.get_finished_spans()
+        server_span = next(s for s in spans if s.kind == SpanKind.SERVER)
+        client_span = next(s for s in spans if s.kind == SpanKind.CLIENT)
+        self.assertEqual(
+            server_span.parent.span_id, client_span.context.span_id
+        )
+        ctxt, _ = self.endpoint.received[0]
+        self.assertEqual(ctxt["user"], "admin")
+
+    def test_call_request_context_serializer(self):
+        client = oslo_messaging.get_rpc_client(
+            self.transport,
+            oslo_messaging.Target(topic="test_topic"),
+            serializer=RequestContextSerializer(),
+        )
+        request_ctxt = FakeRequestContext()
+        self.assertEqual(
+            client.call(request_ctxt, "hello", name="world"), "Hello, world!"
+        )
+        self.assertEqual(request_ctxt.values, {"user": "admin"})
+
+        spans = self.memory_exporter.get_finished_spans()
+        server_span = next(s for s in spans if s.kind == SpanKind.SERVER)
+        client_span = next(s for s in spans if s.kind == SpanKind.CLIENT)
+        self.assertEqual(
+            server_span.parent.span_id, client_span.context.span_id
+        )
+        ctxt, _ = self.endpoint.received[0]
+        self.assertEqual(ctxt["user"], "admin")